@@ -1,3 +1,4 @@
+import mmap
 import os
 import sys
 import numpy as np
@@ -18,11 +19,11 @@ def load_xyzfile(xyzfile):
               may contain more than one configuration concatenated together
 
         Return values:
-            trajectory - a list of numpy arrays, each of shape (N,3), and each
-              containing a single configuration
-            atomtype_list - a list of numpy arrays, each of size N, specifying
-              an atomtype for each atom in the file
-            boxsize_list - a list of numpy arrays, each specifying a set
+            trajectory - a contiguous float32 numpy array of shape
+              (nframes,N,3), where trajectory[i] is the i'th configuration
+            atomtype_list - a numpy array of shape (nframes,N), specifying
+              an atomtype for each atom in each configuration
+            boxsize_list - a numpy array of shape (nframes,3), each row
               (Lx,Ly,Lz) prepresenting simulation box size dimensions 
 
         file format:
@@ -34,46 +35,82 @@ def load_xyzfile(xyzfile):
             Lx Ly Lz
 
     """
-    trajectory = []
-    atomtype_list = []
-    boxsize_list = []
-
-    fh = open(xyzfile,'r')
-    line = fh.readline()
-
-    atomtype_label_list = []
-    N = int( line.split()[0] )
-    while line:
-        configuration = np.zeros((N,3))
-        atomtypes = np.zeros(N,dtype=int)
-        for i in range(N):
-            line = fh.readline()
-            atomid,atomtype,x,y,z = line.split()[:5]
+    # map the file into memory rather than reading it line by line; the map
+    #   is closed on the way out, even if a configuration fails to parse
+    with open(xyzfile,'rb') as fh, mmap.mmap(fh.fileno(),0,access=mmap.ACCESS_READ) as mm:
+        # each configuration is N+2 lines, so the output arrays can be
+        #   allocated once up front
+        N = int( mm[:mm.find(b'\n')].split()[0] )
+        line_ends = frame_line_ends(mm,N)
+        nframes = len(line_ends)
+
+        # positions are stored in single precision, which is plenty for drawing
+        #   and halves the memory of large trajectories
+        trajectory = np.empty((nframes,N,3),dtype=np.float32)
+        atomtype_list = np.empty((nframes,N),dtype=np.int32)
+        boxsize_list = np.empty((nframes,3))
+
+        # maps each atomtype label to its numeric atomtype
+        atomtype_ids = {}
+
+        for frame in range(nframes):
+            header_end, atoms_end, boxsize_end = line_ends[frame]
+            lines = mm[header_end+1:atoms_end].decode().splitlines()
+
+            # parse the positions of all N atoms at once, the i'th row of
+            #   the configuration is the xyz position of atom i
+            trajectory[frame] = np.loadtxt(lines,usecols=(2,3,4),ndmin=2,comments=None)
 
             # this converts atomtype to a numeric atomtype, starting with zero,
-            #   regardless of format
+            #   regardless of format, in order of first appearance in the file
+            labels = np.loadtxt(lines,usecols=(1,),dtype=str,ndmin=1,comments=None)
+            unique_labels, first_index, inverse = np.unique(labels,return_index=True,return_inverse=True)
+            label_ids = np.empty(len(unique_labels),dtype=np.int32)
+            for k in np.argsort(first_index):
+                label_ids[k] = atomtype_ids.setdefault(unique_labels[k],len(atomtype_ids))
+            atomtype_list[frame] = label_ids[inverse]
 
-            if atomtype in atomtype_label_list:
-                atomtype_numeric = atomtype_label_list.index(atomtype) 
-            else:
-                atomtype_numeric = len(atomtype_label_list)
-                atomtype_label_list.append(atomtype)
+            boxsize_list[frame] = mm[atoms_end+1:boxsize_end].split()
 
-            atomtypes[i] = atomtype_numeric
+    return trajectory, atomtype_list, boxsize_list
 
-            pos = np.array((x,y,z),dtype=float)
-            # set the i'th row of configuration to be the xyz position of atomi
-            configuration[i,:] = pos
-        line = fh.readline()
-        boxsize = np.array( line.split(),dtype=float)
+def frame_line_ends(mm,N,chunksize=1<<24):
+    """
 
-        trajectory.append(configuration)
-        atomtype_list.append(atomtypes)
-        boxsize_list.append(boxsize)
+        Find the configurations in a memory mapped xyz file
 
-        line = fh.readline()
+        The file is scanned for newlines in chunks of chunksize bytes, and
+          only three line ends are kept per configuration, so memory use does
+          not grow with the size of the file
 
-    return trajectory, atomtype_list, boxsize_list
+        Arguments:
+            mm - an mmap of a file in the format read by load_xyzfile
+            N - the number of atoms in each configuration
+
+        Return values:
+            line_ends - a numpy array of shape (nframes,3), giving for each
+              configuration the offsets of the ends of its header line, its
+              last atom line and its box size line
+
+    """
+    line_ends = []
+    nlines = 0
+    for offset in range(0,len(mm),chunksize):
+        chunk = np.frombuffer(mm,dtype=np.uint8,count=min(chunksize,len(mm)-offset),offset=offset)
+        ends = offset+np.flatnonzero(chunk == ord('\n'))
+        # release the view of the map, so that it can be closed later
+        del chunk
+        # the line number of each line end within its configuration
+        line_in_frame = (nlines+np.arange(len(ends)))%(N+2)
+        line_ends.append(ends[(line_in_frame == 0) | (line_in_frame == N) | (line_in_frame == N+1)])
+        nlines += len(ends)
+    if not mm[-1:] == b'\n':
+        # the last line is not terminated by a newline
+        if nlines%(N+2) in (0,N,N+1):
+            line_ends.append(np.array([len(mm)]))
+        nlines += 1
+    nframes = nlines//(N+2)
+    return np.concatenate(line_ends)[:3*nframes].reshape(nframes,3)
 
 def divider():
     print("-"*80)
@@ -100,7 +137,7 @@ def main():
     # create a new connection to vmd 
     s = pyvmdstream.vmdstart(port=5556)
     # send a command to vmd
-    s.send("draw sphere {0 0 0} radius 1 resolution 30\n".encode())
+    s.send(b"draw sphere {0 0 0} radius 1 resolution 30\n")
     # wait so you can see the result
     time.sleep(3)
     # stop the connection to vmd
@@ -175,13 +212,24 @@ def main():
     # calculate the "x" distance from the side of the box
     dx = ( configuration[:,0] - boxsize_list[1][0] )
     # scale that distance to the range 0-1
-    dx_scaled = (dx+dx.min())/(dx.max()-dx.min())
-
+    dxmin, dxmax = dx.min(), dx.max()
+    dx_scaled = (dx-dxmin)/(dxmax-dxmin)
+    # the parts of the color and radius that do not change from frame to frame
+    phase = dx_scaled*np.pi
+    radius_list_base = radius_list*0.8
+
+    # allocate the per atom colors and radii once, and refill them each frame
+    color_value_list = np.empty(len(configuration))
+    radius_list_scaled = np.empty(len(configuration))
     for i in range(nframes):
-        # sinusoidally color the particles based on distance from the side
-        color_value_list = 0.5+0.5*np.sin(dx_scaled*np.pi + 2*i*np.pi/nframes-np.pi/2)
+        np.add(phase,2*i*np.pi/nframes-np.pi/2,out=color_value_list)
+        np.sin(color_value_list,out=color_value_list)
         # scale down the radius of eaach atom, then sinusoidally modify it based on the distance from the bottom
-        radius_list_scaled = radius_list*0.8 + 0.2*np.sin(dx_scaled*np.pi + 2*i*np.pi/nframes-np.pi/2)
+        np.multiply(color_value_list,0.2,out=radius_list_scaled)
+        radius_list_scaled += radius_list_base
+        # sinusoidally color the particles based on distance from the side
+        color_value_list *= 0.5
+        color_value_list += 0.5
         vmdstream.draw_atomic( configuration, atomtypes,color_value_list=color_value_list,radius_list=radius_list_scaled )
         # save the configuration and render it using the "tachyon" plugin in vmd
         vmdstream.render_tachyon(file_prefix="test_frame_%02i"%i)
@@ -23,6 +23,8 @@
 
 """
 
+import itertools
+import math
 import os
 import sys
 import socket
@@ -31,38 +33,16 @@ import time
 
 import numpy as np
 
+# numba is optional, and only used to speed up formatting draw commands
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
 # These are hard coded values from vmd version 1.9
 VMDSTARTCOLOR=33
 VMDNCOLORS=1024
 
-# note the following function comes from matplotlib documentation, Jan 17, 2012
-# http://www.scipy.org/Cookbook/Matplotlib/ColormapTransformations
-# cmaps shown on http://www.scipy.org/Cookbook/Matplotlib/Show_colormaps
-def cmap_discretize(N,cmap="jet"):
-    import matplotlib
-    from matplotlib import cm
-    """Return a discrete colormap from the continuous colormap cmap.
-    
-        cmap: colormap instance, eg. cm.jet. 
-        N: number of colors.
-    
-    Example
-        x = resize(arange(100), (5,100))
-        djet = cmap_discretize(cm.jet, 5)
-        imshow(x, cmap=djet)
-    """
-
-    if type(cmap) == str:
-        cmap = matplotlib.cm.get_cmap(cmap)
-    colors_i = np.concatenate((np.linspace(0, 1., N), (0.,0.,0.,0.)))
-    colors_rgba = cmap(colors_i)
-    indices = np.linspace(0, 1., N+1)
-    cdict = {}
-    for ki,key in enumerate(('red','green','blue')):
-        cdict[key] = [ (indices[i], colors_rgba[i-1,ki], colors_rgba[i,ki]) for i in range(N+1) ]
-    # Return colormap object.
-    return matplotlib.colors.LinearSegmentedColormap(cmap.name + "_%d"%N, cdict, 1024)
-
 class VMDStream():
     """ 
 
@@ -89,14 +69,56 @@ class VMDStream():
 
         """
         self.s = vmdstart(command_script,port,vmd_exe)
+        # commands queued by send(...,flush=False), written out by flush()
+        self._buf = bytearray()
+        # per atom work arrays, reused by draw_atomic from frame to frame
+        self._scratch_arrays = {}
+        # sampled named colormaps from set_colorscale, keyed by (name,ncolors)
+        self._cmap_cache = {}
+        # sphere emitter for the most recent (natoms,resolution)
+        self._emitter_key = None
+        self._emitter = None
 
     def close(self):
         """ Close the connection to VMD """
+        self.flush()
         vmdstop(self.s)
 
-    def send(self,sendstring):
-        """ Send a command directly to VMD """
-        self.s.send(sendstring.encode())
+    def send(self,sendstring,flush=True):
+        """
+
+            Send a command (str or bytes) directly to VMD
+
+            If flush is False the command is only queued, and is sent together
+              with any other queued commands on the next call to flush()
+
+        """
+        if isinstance(sendstring,str):
+            sendstring = sendstring.encode()
+        self._buf.extend(sendstring)
+        if flush:
+            self.flush()
+
+    def flush(self):
+        """ Send all queued commands to VMD in a single write """
+        if self._buf:
+            self.s.sendall(self._buf)
+            del self._buf[:]
+
+    def _scratch(self,name,natoms,dtype):
+        """ Return a length natoms work array, reallocated only if N changes """
+        scratch = self._scratch_arrays.get(name)
+        if scratch is None or len(scratch) != natoms:
+            scratch = self._scratch_arrays[name] = np.empty(natoms,dtype=dtype)
+        return scratch
+
+    def _get_emitter(self,natoms,sphere_resolution):
+        """ Return the sphere emitter for this frame, rebuilt only when its shape changes """
+        key = (natoms,sphere_resolution)
+        if key != self._emitter_key:
+            self._emitter = _sphere_emitter(natoms,sphere_resolution)
+            self._emitter_key = key
+        return self._emitter
 
     def draw_atomic( self, configuration, atomtypes=None, default_radius=0.5,
                      radii=None, radius_list=None, color_list=None,
@@ -137,58 +159,78 @@ class VMDStream():
         natoms = len(configuration)
 
         #example initial setup
-        self.send('axes location off\n')
-        self.send('display projection orthographic\n')
-        self.send('display resize 800 800\n')
-        self.send("draw delete all\n")
-        self.send('draw materials on\n')
-        self.send('draw material "HardPlastic"\n')
-
+        self.send(b'axes location off\n'
+                  b'display projection orthographic\n'
+                  b'display resize 800 800\n'
+                  b'draw delete all\n'
+                  b'draw materials on\n'
+                  b'draw material "HardPlastic"\n',flush=False)
+
+        # resolve the per atom colors and radii once for the whole
+        #   configuration, rather than for every sphere and cylinder
         if color_value_list is not None:
-            # readjust color value list
-            color_list = np.array( np.floor( color_value_list*VMDNCOLORS ),dtype=int)
+            # readjust color value list to color ids, clipping 1.0 to the
+            #   last color, without allocating new arrays every frame
+            color_values = self._scratch("color_values",natoms,np.float64)
+            np.multiply(color_value_list,VMDNCOLORS,out=color_values)
+            np.clip(color_values,0,VMDNCOLORS-1,out=color_values)
+            color_per_atom = self._scratch("color_ids",natoms,np.int64)
+            # truncation is the same as floor for the clipped values
+            np.copyto(color_per_atom,color_values,casting="unsafe")
+            color_per_atom += VMDSTARTCOLOR
+        elif color_list is not None:
+            color_per_atom = np.asarray(color_list)+VMDSTARTCOLOR
+        elif atomtypes is not None:
+            color_per_atom = np.asarray(atomtypes)
+        else:
+            color_per_atom = None
+        if radii is not None and atomtypes is not None:
+            # a single gather of the per type radii into a reused array
+            radius_per_atom = self._scratch("radii",natoms,np.float64)
+            np.take(np.asarray(radii,dtype=np.float64),atomtypes,out=radius_per_atom)
+        elif radius_list is not None:
+            radius_per_atom = np.asarray(radius_list,dtype=np.float64)
+        else:
+            radius_per_atom = self._scratch("radii",natoms,np.float64)
+            radius_per_atom.fill(default_radius)
+
+        if skip_list is not None:
+            skipped = np.asarray(skip_list,dtype=bool)
+        else:
+            skipped = np.zeros(natoms,dtype=bool)
+        drawn = np.flatnonzero(~skipped)
 
+        # pairs of atoms (i,j) to connect with cylinders, drawn with the
+        #   color and a fraction of the radius of atom i
+        cylinders = []
         if bond_list is not None:
-            for link_idx in range(len(bond_list)):
-                i,j = bond_list[link_idx]
-                if skip_list is not None and (skip_list[i] or skip_list[j]):continue
-                if color_list is not None:
-                    self.send("draw color %i\n"%(color_list[i]+VMDSTARTCOLOR))
-                elif atomtypes is not None:
-                    self.send("draw color %i\n"%(atomtypes[i]))
-                if radii is not None and atomtypes is not None:
-                    this_radius = radii[atomtypes[i]]        
-                elif radius_list is not None:
-                    this_radius = radius_list[i]
-                else:
-                    this_radius = default_radius
-                self.send("draw cylinder {%f %f %f} {%f %f %f} radius %f resolution %i filled yes\n"%( configuration[i,0],configuration[i,1],configuration[i,2],configuration[j,0],configuration[j,1],configuration[j,2],this_radius*cylinder_radius_fraction,sphere_resolution) )
-
-        for i in range(len(configuration)):
-            if skip_list is not None and skip_list[i]:continue
-
-            if color_list is not None:
-                self.send("draw color %i\n"%(color_list[i]+VMDSTARTCOLOR))
-            elif atomtypes is not None:
-                self.send("draw color %i\n"%(atomtypes[i]))
-
-            if radii is not None and atomtypes is not None:
-                this_radius = radii[atomtypes[i]]        
-            elif radius_list is not None:
-                this_radius = radius_list[i]
-            else:
-                this_radius = default_radius
-    
-            self.send("draw sphere {%f %f %f} radius %f resolution %i\n"%( configuration[i,0],configuration[i,1],configuration[i,2],this_radius,sphere_resolution) )
-            if i+1<len(configuration) and connecting_segments_types is not None:
-                for connecting_segments_type in connecting_segments_types:
-                    if atomtypes[i] == connecting_segments_type and atomtypes[i+1] == connecting_segments_type:
-                        self.send("draw cylinder {%f %f %f} {%f %f %f} radius %f resolution %i filled yes\n"%( configuration[i,0],configuration[i,1],configuration[i,2],configuration[i+1,0],configuration[i+1,1],configuration[i+1,2],this_radius*cylinder_radius_fraction,sphere_resolution) )
- 
+            bond_list = np.asarray(bond_list,dtype=np.int64).reshape(-1,2)
+            cylinders.append(bond_list[~(skipped[bond_list[:,0]] | skipped[bond_list[:,1]])])
+        if connecting_segments_types is not None:
+            atomtypes = np.asarray(atomtypes)
+            i = drawn[drawn+1 < natoms]
+            i = i[(atomtypes[i] == atomtypes[i+1]) & np.isin(atomtypes[i],connecting_segments_types)]
+            cylinders.append(np.column_stack((i,i+1)))
+        if cylinders:
+            i,j = np.concatenate(cylinders).T
+            self.send(_cylinder_commands(configuration[i],configuration[j],
+                                         radius_per_atom[i]*cylinder_radius_fraction,
+                                         None if color_per_atom is None else color_per_atom[i],
+                                         sphere_resolution),flush=False)
+
+        emit = self._get_emitter(len(drawn),sphere_resolution)
+        if color_per_atom is None:
+            self.send(emit(configuration[drawn],radius_per_atom[drawn],None),flush=False)
+        else:
+            # draw the spheres grouped by color, so that each color is set once
+            drawn = drawn[np.argsort(color_per_atom[drawn],kind="stable")]
+            self.send(emit(configuration[drawn],radius_per_atom[drawn],color_per_atom[drawn]),flush=False)
 
         if reset_view is True:
-            self.send('display resetview\n')
-            self.send('scale by 1.3\n')
+            self.send(b'display resetview\n'
+                      b'scale by 1.3\n',flush=False)
+
+        self.flush()
 
     def set_colorscale(self,colormap="jet",ncolors=VMDNCOLORS,startcolorid=VMDSTARTCOLOR):
         """
@@ -203,16 +245,28 @@ class VMDStream():
         # an alternative would be to change the colorscale in vmd, e.g.
         #    self.send("color scale method GWR\n")
         if colormap == "":
-            self.send("color scale method RGB\n")
+            self.send(b"color scale method RGB\n")
         else:
-            # this is an obj that takes a number in zero to one and returns
-            #   r g b intensity values
-            colors = cmap_discretize(ncolors,cmap=colormap)
-            for i in range(ncolors):
-                color_frac = float(i)/float(ncolors)
-                color_vals = colors(color_frac)[:3]
-                # set color startcolor+i to r g b value
-                self.send("color change rgb %i %0.3f %0.3f %0.3f\n"%( startcolorid+i,color_vals[0],color_vals[1],color_vals[2]))
+            # sample the continuous colormap at ncolors evenly spaced points,
+            #   giving an (ncolors,3) array of r g b intensity values. Only
+            #   colormaps given by name are cached, since distinct Colormap
+            #   instances (resampled, reversed, ...) can share a name
+            if isinstance(colormap,str):
+                rgb = self._cmap_cache.get((colormap,ncolors))
+                if rgb is None:
+                    import matplotlib
+                    if hasattr(matplotlib,"colormaps"):
+                        cmap = matplotlib.colormaps[colormap]
+                    else:
+                        # matplotlib older than 3.5
+                        from matplotlib import cm
+                        cmap = cm.get_cmap(colormap)
+                    rgb = cmap(np.linspace(0,1,ncolors))[:,:3]
+                    self._cmap_cache[(colormap,ncolors)] = rgb
+            else:
+                rgb = colormap(np.linspace(0,1,ncolors))[:,:3]
+            # set color startcolor+i to r g b value
+            self.send(b"".join([ b"color change rgb %i %0.3f %0.3f %0.3f\n"%( startcolorid+i,r,g,b) for i,(r,g,b) in enumerate(rgb.tolist()) ]))
 
     def render_tachyon(self,file_prefix="test_frame",extra_commands=""):
         """ Render file via tachyon with current VMD defaults """
@@ -220,6 +274,183 @@ class VMDStream():
         #self.send('render Tachyon %(FILE_PREFIX)s "tachyon" -aasamples 12 %%s -format TARGA -o %%s.tga\n'%{'FILE_PREFIX':file_prefix+'.dat'})
         self.send('render Tachyon %(FILE_PREFIX)s "/software/vmd-1.9.2-x86_64/lib/tachyon_LINUXAMD64" %(EXTRA_COMMANDS)s -aasamples 12 %%s -format TARGA -o %%s.tga\n'%{'FILE_PREFIX':file_prefix+'.dat','EXTRA_COMMANDS':extra_commands})
 
+def _sphere_emitter(natoms,sphere_resolution):
+    """
+        Return a function emit(configuration,radius_list,color_list) giving
+          the VMD commands, as bytes, drawing a sphere for each atom
+
+        The emitter is specialized to natoms spheres of one resolution, so it
+          can be built once and reused for every frame of a movie.
+
+        Arguments to emit:
+            configuration     - An (natoms,3) numpy array giving the sphere
+                                  centers
+            radius_list       - A length natoms numpy array of sphere radii
+            color_list        - A length natoms numpy array of VMD color ids,
+                                  or None if not colored. A draw color is sent
+                                  before the first sphere and whenever the
+                                  color changes, so spheres sorted by color
+                                  need fewest commands
+
+    """
+    # a single format string for the whole configuration, filled in with one
+    #   % from native python numbers (tolist is much cheaper than indexing
+    #   the numpy arrays per atom). The first n spheres of the template are
+    #   the template for n spheres, which formats each run of one color.
+    sphere_fmt = b"draw sphere {%%f %%f %%f} radius %%f resolution %i\n"%sphere_resolution
+    template = sphere_fmt*natoms
+    def emit(configuration,radius_list,color_list):
+        values = tuple(itertools.chain.from_iterable(zip(
+            configuration[:,0].tolist(), configuration[:,1].tolist(),
+            configuration[:,2].tolist(), radius_list.tolist() )))
+        if color_list is None or len(color_list) == 0:
+            return template%values
+        runs = np.concatenate(([0],np.flatnonzero(np.diff(color_list))+1,[len(color_list)])).tolist()
+        colors = color_list.tolist()
+        return b"".join([ b"draw color %i\n"%colors[start] + template[:(end-start)*len(sphere_fmt)]%values[4*start:4*end]
+                          for start,end in zip(runs[:-1],runs[1:]) ])
+    if njit is None:
+        return emit
+
+    python_emit = emit
+    def emit(configuration,radius_list,color_list):
+        configuration = np.asarray(configuration,dtype=np.float64)
+        radius_list = np.asarray(radius_list,dtype=np.float64)
+        # the compiled writer only handles finite values of up to 15 integer
+        #   digits, so frames with nan, inf or huge values are left to the
+        #   python formatting, which writes them the way "%f" does
+        if not ( np.all(np.abs(configuration) < _FLOAT_MAX) and np.all(np.abs(radius_list) < _FLOAT_MAX) ):
+            return python_emit(configuration,radius_list,color_list)
+        if color_list is None:
+            color_list = np.empty(0,dtype=np.int64)
+        return _format_spheres(configuration,radius_list,
+                               np.asarray(color_list,dtype=np.int64),
+                               sphere_resolution).tobytes()
+    return emit
+
+def _cylinder_commands(start,end,radius_list,color_list=None,cylinder_resolution=30):
+    """
+        Return the VMD commands, as bytes, drawing a cylinder between each
+          pair of points
+
+        Arguments:
+            start,end           - (M,3) numpy arrays giving the two ends of
+                                    each cylinder
+            radius_list         - A length M numpy array of cylinder radii
+            color_list          - Optional length M numpy array of VMD color
+                                    ids, each cylinder is preceded by its
+                                    draw color
+            cylinder_resolution - VMD cylinder resolution, integer
+
+    """
+    cylinders = [ start[:,0].tolist(), start[:,1].tolist(), start[:,2].tolist(),
+                  end[:,0].tolist(), end[:,1].tolist(), end[:,2].tolist(),
+                  radius_list.tolist() ]
+    cylinder_fmt = b"draw cylinder {%%f %%f %%f} {%%f %%f %%f} radius %%f resolution %i filled yes\n"%cylinder_resolution
+    if color_list is not None:
+        cylinder_fmt = b"draw color %i\n"+cylinder_fmt
+        cylinders.insert(0,color_list.tolist())
+    return b"".join([ cylinder_fmt%cylinder for cylinder in zip(*cylinders) ])
+
+# The functions below write the same text as the python emitter's "%f"/"%i"
+#   formatting straight into a byte array, so that numba can compile the
+#   loop over atoms. Each returns the position after the last byte written.
+
+def _write_text(buf,pos,text):
+    for k in range(len(text)):
+        buf[pos+k] = text[k]
+    return pos+len(text)
+
+def _write_int(buf,pos,value):
+    if value < 0:
+        buf[pos] = 45 # '-'
+        pos += 1
+        value = -value
+    ndigits = 1
+    while value >= 10**ndigits and ndigits < 19:
+        ndigits += 1
+    for k in range(ndigits-1,-1,-1):
+        buf[pos+k] = 48 + value%10
+        value //= 10
+    return pos+ndigits
+
+def _product_error(a,b,product):
+    # the rounding error of product = a*b, so that a*b == product+error
+    #   exactly (Dekker's two-product, splitting each factor in halves)
+    split = 134217729.0 # 2**27+1
+    t = split*a
+    ahi = t-(t-a)
+    alo = a-ahi
+    t = split*b
+    bhi = t-(t-b)
+    blo = b-bhi
+    return ((ahi*bhi-product)+ahi*blo+alo*bhi)+alo*blo
+
+def _write_float(buf,pos,value):
+    # fixed point with six decimals, like "%f", which rounds the exact
+    #   binary value half to even; whole and the fraction split from it are
+    #   exact, and the error of fraction*1e6 is tracked so that values near
+    #   a half-way point round the same way
+    if math.copysign(1.0,value) < 0:
+        buf[pos] = 45 # '-'
+        pos += 1
+        value = -value
+    whole = np.floor(value)
+    scaled = (value-whole)*1000000.0
+    error = _product_error(value-whole,1000000.0,scaled)
+    fraction = np.floor(scaled)
+    above_half = (scaled-fraction-0.5)+error
+    if above_half > 0 or (above_half == 0 and fraction%2 == 1):
+        fraction += 1
+    whole = np.int64(whole)
+    fraction = np.int64(fraction)
+    if fraction == 1000000:
+        whole += 1
+        fraction = 0
+    pos = _write_int(buf,pos,whole)
+    buf[pos] = 46 # '.'
+    pos += 1
+    for k in range(6,0,-1):
+        buf[pos+k-1] = 48 + fraction%10
+        fraction //= 10
+    return pos+6
+
+# _write_float is only used for magnitudes below this
+_FLOAT_MAX = 1e15
+
+# upper bound on the length of the commands for one atom
+_SPHERE_MAXBYTES = 256
+
+def _format_spheres(configuration,radius_list,color_list,sphere_resolution):
+    buf = np.empty(len(configuration)*_SPHERE_MAXBYTES,dtype=np.uint8)
+    pos = 0
+    for i in range(len(configuration)):
+        if len(color_list) and (i == 0 or color_list[i] != color_list[i-1]):
+            pos = _write_text(buf,pos,b"draw color ")
+            pos = _write_int(buf,pos,color_list[i])
+            buf[pos] = 10 # '\n'
+            pos += 1
+        pos = _write_text(buf,pos,b"draw sphere {")
+        pos = _write_float(buf,pos,configuration[i,0])
+        buf[pos] = 32 # ' '
+        pos = _write_float(buf,pos+1,configuration[i,1])
+        buf[pos] = 32
+        pos = _write_float(buf,pos+1,configuration[i,2])
+        pos = _write_text(buf,pos,b"} radius ")
+        pos = _write_float(buf,pos,radius_list[i])
+        pos = _write_text(buf,pos,b" resolution ")
+        pos = _write_int(buf,pos,sphere_resolution)
+        buf[pos] = 10 # '\n'
+        pos += 1
+    return buf[:pos]
+
+if njit is not None:
+    _write_text = njit(cache=True)(_write_text)
+    _write_int = njit(cache=True)(_write_int)
+    _product_error = njit(cache=True)(_product_error)
+    _write_float = njit(cache=True)(_write_float)
+    _format_spheres = njit(cache=True)(_format_spheres)
+
 def ctl_script(port):
     """
         Return a vmd startup script
@@ -328,7 +559,7 @@ remote_ctl::putlog "telnet localhost %(PORT)s"
 remote_ctl::start
 """%{'PORT':port}
 
-def vmdstart(command_script="remote_ctl.tcl",port=5555, vmd_exe="vmd"):
+def vmdstart(command_script="remote_ctl.tcl",port=5555, vmd_exe="vmd", timeout=30):
     """
         Start a VMD session
 
@@ -340,23 +571,42 @@ def vmdstart(command_script="remote_ctl.tcl",port=5555, vmd_exe="vmd"):
               VMD startup commands will be written out. Note: this file will be
               overwritten. The default is 'remote_ctl.tcl'
             port=PORT -- this specifies TCP port VMD will open
+            timeout=TIMEOUT -- seconds to wait for VMD to open the port before
+              giving up
+
+        Raises RuntimeError if VMD exits before opening the port, and
+          ConnectionRefusedError if the port is still closed after TIMEOUT.
 
     """
-    open(command_script,'w').write( ctl_script(port) )
+    with open(command_script,'w') as fh:
+        fh.write( ctl_script(port) )
     cmd = subprocess.Popen("%s -e "%vmd_exe+command_script,shell=True)
-    time.sleep(5)
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    for i in range(5):
+
+    # poll until VMD is listening, starting at 50 ms between attempts and
+    #   backing off to at most 0.5 s, instead of sleeping a fixed time
+    deadline = time.monotonic()+timeout
+    delay = 0.05
+    while True:
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # draw commands are written a whole frame at a time, so send them
+        #   immediately rather than waiting to coalesce small writes, and
+        #   let the kernel accept a large frame in one go
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1<<20)
         try:
             s.connect(("127.0.0.1",port))
-        except Exception as e:
-            if e.errno == 106 or e.errno == 56:
-                #already connected
-                break
-            else:
-                print(e)
-        time.sleep(2)
-    return s
+            return s
+        except ConnectionRefusedError:
+            # a socket is not reusable after a failed connect on all platforms
+            s.close()
+            # stop waiting as soon as VMD has exited, e.g. if vmd_exe is wrong
+            #   or VMD crashed during startup
+            if cmd.poll() is not None:
+                raise RuntimeError("'%s -e %s' exited with status %i before opening port %i"%(vmd_exe,command_script,cmd.returncode,port))
+            if time.monotonic()+delay > deadline:
+                raise
+            time.sleep(delay)
+            delay = min(delay*1.5,0.5)
 
 def vmdstop(s):
     """
@@ -369,6 +619,6 @@ def vmdstop(s):
             s=SOCKET - an open python socket object
 
     """
-    s.send("exit\n".encode())
+    s.send(b"exit\n")
     s.close()
 